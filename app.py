@@ -1,21 +1,50 @@
-import os, json, math, time, threading, logging
+import os, json, math, time, threading, logging, ssl, atexit, hmac, socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from typing import Any, Dict, Tuple, Optional, Callable
-from flask import Flask, request, jsonify
+
 import ccxt
+import requests
+from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson absent: on retombe sur le json stdlib
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # hors Unix: pas de verrou inter-process
+    fcntl = None
 
 # ===== Helpers ENV =====
 def env_str(name: str, default: str = "") -> str:
     v = os.getenv(name)
     return v if v not in (None, "") else default
 
+_TRUTHY = frozenset({"1", "true", "yes", "y", "on"})
+
+def env_bool(name: str, default: bool = False) -> bool:
+    v = os.getenv(name)
+    if not v: return default
+    return v.strip().lower() in _TRUTHY
+
 def env_float(name: str, default: float = 0.0) -> float:
-    try: return float(env_str(name, str(default)))
-    except: return float(default)
+    v = os.getenv(name)
+    if not v: return default
+    try: return float(v)
+    except ValueError: return default
 
 def env_int(name: str, default: int = 0) -> int:
-    try: return int(float(env_str(name, str(default))))
-    except: return int(default)
+    v = os.getenv(name)
+    if not v: return default
+    try: return int(float(v))   # accepte "300" comme "300.0"
+    except (ValueError, OverflowError): return default
 
 # ===== ENV =====
 LOG_LEVEL              = env_str("LOG_LEVEL", "INFO").upper()
@@ -36,37 +65,83 @@ RISK_PCT               = env_float("RISK_PCT", 0.02)
 MAX_SL_PCT             = env_float("MAX_SL_PCT", 0.05)
 BUY_COOL_SEC           = env_int("BUY_COOL_SEC", 300)
 
-DRY_RUN                = env_str("DRY_RUN", "false").lower() in ("1","true","yes")
+DRY_RUN                = env_bool("DRY_RUN", False)
+DRY_RUN_PRICE          = max(0.0, env_float("DRY_RUN_PRICE", 0.0))        # 0 = ticker public réel
+DRY_RUN_QUOTE_FREE     = max(0.0, env_float("DRY_RUN_QUOTE_FREE", 1000.0))
 WEBHOOK_SECRET         = env_str("WEBHOOK_SECRET", env_str("WEBHOOK_TOKEN", ""))
+_WEBHOOK_SECRET_B      = WEBHOOK_SECRET.encode()
 
-TRAILING_ENABLED          = env_str("TRAILING_ENABLED","true").lower() in ("1","true","yes")
+TRAILING_ENABLED          = env_bool("TRAILING_ENABLED", True)
 TRAIL_ACTIVATE_PCT_CONF2  = env_float("TRAIL_ACTIVATE_PCT_CONF2", 0.004)
 TRAIL_GAP_CONF2           = env_float("TRAIL_GAP_CONF2", 0.002)
 TRAIL_ACTIVATE_PCT_CONF3  = env_float("TRAIL_ACTIVATE_PCT_CONF3", 0.006)
 TRAIL_GAP_CONF3           = env_float("TRAIL_GAP_CONF3", 0.003)
 
 STATE_FILE             = env_str("STATE_FILE", "/tmp/bot_state.json")
-RESTORE_ON_START       = env_str("RESTORE_ON_START","true").lower() in ("1","true","yes")
+RESTORE_ON_START       = env_bool("RESTORE_ON_START", True)
+ORDER_LOCK_FILE        = env_str("ORDER_LOCK_FILE", STATE_FILE + ".lock")
+IDEMPOTENCY_TTL_SEC    = max(0, env_int("IDEMPOTENCY_TTL_SEC", 60))     # 0 = désactivé
+IDEMPOTENCY_BUCKET_SEC = max(1, env_int("IDEMPOTENCY_BUCKET_SEC", 5))      # fenêtre glissante sans id
 
 API_KEY                = env_str("KRAKEN_API_KEY", env_str("API_KEY",""))
 API_SECRET             = env_str("KRAKEN_API_SECRET", env_str("API_SECRET",""))
 
 KRAKEN_ENV             = env_str("KRAKEN_ENV","mainnet").lower()
 KRAKEN_DEFAULT_TYPE    = env_str("KRAKEN_DEFAULT_TYPE","spot").lower()
+KRAKEN_SANDBOX         = KRAKEN_ENV in ("testnet","sandbox","demo","paper","true","1","yes")
 
 BUY_SPLIT_CHUNKS       = max(1, env_int("BUY_SPLIT_CHUNKS", 1))
 BUY_SPLIT_DELAY_MS     = max(0, env_int("BUY_SPLIT_DELAY_MS", 300))
 SELL_SPLIT_CHUNKS      = max(1, env_int("SELL_SPLIT_CHUNKS", 1))
 
 # --- Shorting (margin spot)
-ENABLE_SHORTING        = env_str("ENABLE_SHORTING","false").lower() in ("1","true","yes")
+ENABLE_SHORTING        = env_bool("ENABLE_SHORTING", False)
 MARGIN_LEVERAGE        = max(1, env_int("MARGIN_LEVERAGE", 2))
-ALLOW_PAYLOAD_SYMBOL   = env_str("ALLOW_PAYLOAD_SYMBOL","false").lower() in ("1","true","yes")
+ALLOW_PAYLOAD_SYMBOL   = env_bool("ALLOW_PAYLOAD_SYMBOL", False)
+
+# --- Cache disque des marchés Kraken (évite le load_markets au redémarrage)
+MARKETS_CACHE_FILE     = env_str("MARKETS_CACHE_FILE", "/tmp/kraken_markets.json")
+MARKETS_CACHE_TTL_SEC  = max(0, env_int("MARKETS_CACHE_TTL_SEC", 86400))
+MARKETS_REFRESH_SEC    = max(0, env_int("MARKETS_REFRESH_SEC", 3600))     # 0 = pas de refresh périodique
+
+# --- Cache court des lectures REST (0 = désactivé)
+TICKER_TTL_SEC         = max(0.0, env_float("TICKER_TTL_SEC", 0.5))
+BALANCE_TTL_SEC        = max(0.0, env_float("BALANCE_TTL_SEC", 1.5))
+
+# --- Ticker WebSocket (ccxt.pro) en arrière-plan, REST en secours si périmé
+WS_TICKER              = env_bool("WS_TICKER", False)
+WS_STALE_SEC           = max(0.0, env_float("WS_STALE_SEC", 5.0))
+
+# --- HTTP (retries urllib3, requêtes idempotentes uniquement)
+HTTP_RETRIES           = max(0, env_int("HTTP_RETRIES", 2))
+HTTP_BACKOFF_SEC       = max(0.0, env_float("HTTP_BACKOFF_SEC", 0.3))
 
 # ===== Logs/Flask/State =====
 logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO))
 log = logging.getLogger("tv-kraken")
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None: return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+class _OrjsonProvider(DefaultJSONProvider):
+    """jsonify()/get_json() via orjson (Rust) au lieu du json stdlib."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__)
+if orjson is not None: app.json = _OrjsonProvider(app)
 
 _state_lock = threading.Lock()
 _position_lock = threading.Lock()
@@ -81,76 +156,237 @@ _state: Dict[str, Any] = {
 
 def _now() -> float: return time.time()
 
+# Écriture du state hors du chemin webhook: _save_state() marque le state
+# "dirty", un thread dédié coalesce les écritures (tmp + os.replace atomique).
+_state_dirty = threading.Event()
+
+_last_state_bytes = b""
+_state_write_lock = threading.Lock()   # flusher et atexit partagent le même .tmp
+
+def _write_state_atomic():
+    global _last_state_bytes
+    with _state_write_lock:
+        try:
+            with _state_lock: data = _json_dumps(_state)
+            if data == _last_state_bytes: return   # rien n'a changé: pas d'I/O
+            path = STATE_FILE + ".tmp"
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(path, STATE_FILE)
+            _last_state_bytes = data
+        except Exception as e:
+            log.warning("STATE save error: %s", e)
+
+def _state_flusher():
+    while True:
+        _state_dirty.wait()
+        _state_dirty.clear()
+        _write_state_atomic()
+
 def _save_state():
-    try:
-        with _state_lock: tmp = json.dumps(_state)
-        with open(STATE_FILE, "w", encoding="utf-8") as f: f.write(tmp)
-    except Exception as e:
-        log.warning("STATE save error: %s", e)
+    _state_dirty.set()
 
 def _load_state():
     if not RESTORE_ON_START: return
     try:
         if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r", encoding="utf-8") as f: data = json.load(f)
+            with open(STATE_FILE, "rb") as f: data = _json_loads(f.read())
             with _state_lock: _state.update(data)
-            log.info("STATE restored: %s", json.dumps(_state))
+            _restore_buy_cooldown(float(_state.get("last_buy_ts") or 0.0))
+            if log.isEnabledFor(logging.INFO):
+                log.info("STATE restored: %s", _json_dumps(_state).decode())
     except Exception as e:
         log.warning("STATE load error: %s", e)
 
-def _with_state(mutator: Callable[[Dict[str, Any]], None]):
+def _with_state(mutator: Callable[[Dict[str, Any]], None], flush: bool = False):
     with _state_lock:
         mutator(_state)
         snap = dict(_state)
-    _save_state()
+    # flush=True: écrit avant de répondre (ex: last_buy_ts, critique pour le cooldown)
+    if flush: _write_state_atomic()
+    else: _save_state()
     return snap
 
+# Cooldown BUY sur horloge monotone en ns (insensible aux sauts NTP);
+# "last_buy_ts" (wall clock) reste dans le state pour la persistance.
+_BUY_COOL_NS = BUY_COOL_SEC * 1_000_000_000
+_buy_cool_until_ns = 0   # échéance précalculée: un seul compare par check
+
+def _mark_buy_now():
+    global _buy_cool_until_ns
+    _buy_cool_until_ns = time.monotonic_ns() + _BUY_COOL_NS
+
+def _restore_buy_cooldown(last_buy_ts: float):
+    global _buy_cool_until_ns
+    elapsed_ns = int((_now() - last_buy_ts) * 1_000_000_000)
+    if last_buy_ts and 0 <= elapsed_ns < _BUY_COOL_NS:
+        _buy_cool_until_ns = max(_buy_cool_until_ns,
+                                 time.monotonic_ns() + _BUY_COOL_NS - elapsed_ns)
+
+def _sync_buy_cooldown():
+    # Un autre worker a pu acheter: relit last_buy_ts (écrit en synchrone
+    # par le BUY) sous le flock, avant le check du cooldown.
+    if not _BUY_COOL_NS: return
+    try:
+        with open(STATE_FILE, "rb") as f: data = _json_loads(f.read())
+        _restore_buy_cooldown(float(data.get("last_buy_ts") or 0.0))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("STATE cooldown sync error: %s", e)
+
+def _buy_cooldown_remaining_ns() -> int:
+    return max(0, _buy_cool_until_ns - time.monotonic_ns())
+
 # ===== Exchange helpers =====
 def _assert_env():
     if EXCHANGE_NAME != "kraken":
         raise RuntimeError(f"Exchange non supporté: {EXCHANGE_NAME}")
-    if not API_KEY or not API_SECRET:
+    if not DRY_RUN and (not API_KEY or not API_SECRET):
         raise RuntimeError("KRAKEN_API_KEY / KRAKEN_API_SECRET manquants")
 
+_QUOTE_SUFFIXES = ("USDT","USD","USDC","EUR","BTC","ETH")
+_SYMBOL_TR      = str.maketrans({" ": "", "-": "/"})
+_ASSET_ALIASES  = {"XBT": "BTC", "XXBT": "BTC", "ZEUR": "EUR", "ZUSD": "USD"}
+
+@lru_cache(maxsize=32)
 def _normalize_to_ccxt_symbol(s: str) -> str:
     if not s: return SYMBOL_DEFAULT
-    s = s.replace("-", "/").upper()
+    s = s.upper().translate(_SYMBOL_TR)
     if "/" not in s:
-        for q in ("USDT","USD","USDC","EUR","BTC","ETH"):
+        for q in _QUOTE_SUFFIXES:
             if s.endswith(q):
                 s = f"{s[:-len(q)]}/{q}"
                 break
         else:
             return SYMBOL_DEFAULT
     base, quote = s.split("/")
-    if base == "XBT": base = "BTC"
-    return f"{base}/{quote}"
+    return f"{_ASSET_ALIASES.get(base, base)}/{_ASSET_ALIASES.get(quote, quote)}"
+
+@lru_cache(maxsize=32)
+def _symbol_parts(symbol: str) -> Tuple[str, str]:
+    base, quote = symbol.split("/")
+    return base, quote
 
 def _maybe_symbol_from_payload(payload_symbol: Optional[str]) -> str:
     if ALLOW_PAYLOAD_SYMBOL and payload_symbol:
         return _normalize_to_ccxt_symbol(payload_symbol)
     return _state.get("symbol", SYMBOL_DEFAULT)
 
+# Session HTTP partagée: le pool urllib3 garde la connexion TLS vers Kraken
+# ouverte entre deux alertes TradingView (pas de handshake par requête).
+# Retry dans l'adapter, uniquement sur GET (données publiques): un POST privé
+# (ordre, balance) n'est jamais rejoué automatiquement.
+# SO_KEEPALIVE (+ sondes TCP ~60 s sous Linux): une connexion poolée coupée par
+# un NAT/LB inactif est détectée au lieu de bloquer l'ordre suivant jusqu'au timeout.
+_KEEPALIVE_OPTS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _opt, _val in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+    if hasattr(socket, _opt): _KEEPALIVE_OPTS.append((socket.IPPROTO_TCP, getattr(socket, _opt), _val))
+
+class _KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + _KEEPALIVE_OPTS
+        super().init_poolmanager(*args, **kwargs)
+
+_http_session = requests.Session()
+_http_session.mount("https://", _KeepAliveAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_SEC,
+                      status_forcelist=[500, 502, 503, 504, 520, 522, 524],
+                      allowed_methods=frozenset(["GET"])),
+))
+
+_exchange = None
+_exchange_lock = threading.Lock()
+
+# Petit pool pour lancer en parallèle des appels REST indépendants (balance + ticker).
+_io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kraken-io")
+
 def _make_exchange():
-    _assert_env()
-    ex = ccxt.kraken({
-        "apiKey": API_KEY,
-        "secret": API_SECRET,
-        "options": {"defaultType": KRAKEN_DEFAULT_TYPE},
-        "enableRateLimit": True,
-    })
-    if KRAKEN_ENV in ("testnet","sandbox","demo","paper","true","1","yes"):
-        try: ex.set_sandbox_mode(True)
-        except Exception: pass
-    return ex
-
-@lru_cache(maxsize=1)
-def _load_markets(ex): return ex.load_markets()
-
-def _amount_step_from_market(market: Dict[str, Any]) -> Optional[float]:
+    global _exchange
+    if _exchange is not None: return _exchange
+    with _exchange_lock:
+        if _exchange is not None: return _exchange
+        _assert_env()
+        ex = ccxt.kraken({
+            "apiKey": API_KEY,
+            "secret": API_SECRET,
+            "options": {"defaultType": KRAKEN_DEFAULT_TYPE},
+            "enableRateLimit": True,
+            "session": _http_session,
+        })
+        if KRAKEN_SANDBOX:
+            try: ex.set_sandbox_mode(True)
+            except Exception: pass
+        _exchange = ex
+    return _exchange
+
+# Index symbole ccxt -> marché. Pas d'alias XBT: les appels ccxt qui suivent
+# exigent le symbole unifié (BTC/EUR), déjà produit par _normalize_to_ccxt_symbol.
+_market_index: Dict[str, Dict[str, Any]] = {}
+
+def _index_markets(markets: Dict[str, Dict[str, Any]]):
+    global _market_index
+    _market_index = dict(markets)   # swap atomique: un lecteur ne voit jamais un index vide
+
+def _read_markets_cache(ex) -> bool:
+    try:
+        if not MARKETS_CACHE_TTL_SEC or not os.path.exists(MARKETS_CACHE_FILE): return False
+        if _now() - os.path.getmtime(MARKETS_CACHE_FILE) > MARKETS_CACHE_TTL_SEC: return False
+        with open(MARKETS_CACHE_FILE, "rb") as f: data = _json_loads(f.read())
+        ex.set_markets(data["markets"], data.get("currencies"))
+        return True
+    except Exception as e:
+        log.warning("MARKETS cache read error: %s", e)
+        return False
+
+def _write_markets_cache(ex):
+    try:
+        path = MARKETS_CACHE_FILE + ".tmp"
+        with open(path, "wb") as f:
+            f.write(_json_dumps({"markets": ex.markets, "currencies": ex.currencies}))
+        os.replace(path, MARKETS_CACHE_FILE)
+    except Exception as e:
+        log.warning("MARKETS cache write error: %s", e)
+
+def _refresh_markets(ex):
+    try:
+        _index_markets(ex.load_markets(reload=True))
+        _market_trade_info.cache_clear()   # limites/pas recalculés au prochain appel
+        _write_markets_cache(ex)
+        log.info("MARKETS refreshed (%d)", len(ex.markets))
+    except Exception as e:
+        log.warning("MARKETS refresh error: %s", e)
+
+# Chargement unique: fast path sans lock une fois l'Event posé.
+_markets_ready = threading.Event()
+_markets_lock = threading.Lock()
+
+def _load_markets(ex):
+    if _markets_ready.is_set(): return ex.markets
+    with _markets_lock:
+        if not _markets_ready.is_set():
+            if _read_markets_cache(ex):
+                # Snapshot disque servi tout de suite, rafraîchi en arrière-plan.
+                threading.Thread(target=_refresh_markets, args=(ex,), name="markets-refresh", daemon=True).start()
+            else:
+                ex.load_markets()
+                _write_markets_cache(ex)
+            _index_markets(ex.markets)
+            _markets_ready.set()
+    return ex.markets
+
+def _amount_step_from_market(market: Dict[str, Any], tick_size: bool = False) -> Optional[float]:
     precision = (market.get("precision") or {}).get("amount")
     if precision is not None:
-        try: return 10 ** (-int(precision))
+        try:
+            # TICK_SIZE (ccxt 4 / Kraken): precision = pas (1e-08); sinon nb de décimales
+            if tick_size: return float(precision) or None
+            return 10 ** (-int(precision))
         except: pass
     info = market.get("info") or {}
     for k in ("lotSz","lotSize","qtyStep","minQty"):
@@ -161,42 +397,159 @@ def _amount_step_from_market(market: Dict[str, Any]) -> Optional[float]:
             except: continue
     return None
 
-def _get_min_trade_info(ex, symbol: str, price: float) -> Tuple[float, float, Optional[float]]:
-    markets = _load_markets(ex)
-    if symbol not in markets:
+@lru_cache(maxsize=64)
+def _market_trade_info(symbol: str) -> Tuple[float, float, Optional[float], Optional[Tuple[int, int]]]:
+    # Limites/pas d'un marché: figés pour la vie du process, calculés une fois.
+    ex = _make_exchange()
+    _load_markets(ex)
+    m = _market_index.get(symbol)
+    if m is None:
         raise RuntimeError(f"Symbole inconnu côté exchange: {symbol}")
-    m = markets[symbol]
     limits = m.get("limits") or {}
     min_amount = float((limits.get("amount") or {}).get("min") or 0.0)
     min_cost   = float((limits.get("cost")   or {}).get("min") or 0.0)
-    step       = _amount_step_from_market(m)
+    step       = _amount_step_from_market(m, ex.precisionMode == ccxt.TICK_SIZE)
+    return min_amount, min_cost, step, _step_scale(step)
+
+def _get_min_trade_info(ex, symbol: str, price: float) -> Tuple[float, float, Optional[float], Optional[Tuple[int, int]]]:
+    min_amount, min_cost, step, lot = _market_trade_info(symbol)
     if min_amount and price and (min_amount * price) > 200:
-        log.warning("Ignoring absurd min_amount=%s (~%.2f %s)", min_amount, min_amount*price, symbol.split("/")[1])
+        log.warning("Ignoring absurd min_amount=%s (~%.2f %s)", min_amount, min_amount*price, _symbol_parts(symbol)[1])
         min_amount = 0.0
-    return min_amount, min_cost, step
-
-def _round_floor(value: float, step: float) -> float:
-    if not step or step <= 0: return value
-    return math.floor(value / step) * step
+    return min_amount, min_cost, step, lot
+
+def _step_scale(step: Optional[float]) -> Optional[Tuple[int, int]]:
+    # Pas -> (lots, échelle) entiers exacts: 1e-08 -> (1, 10**8), 0.25 -> (25, 100)
+    if not step or step <= 0: return None
+    scale = 1
+    while scale < 10**12 and abs(step * scale - round(step * scale)) > 1e-9 * step * scale:
+        scale *= 10
+    return max(1, round(step * scale)), scale
+
+def _round_floor(value: float, lot: Tuple[int, int]) -> float:
+    # lot = (lots, échelle) de _market_trade_info. round() puis recul d'une
+    # unité si ça dépasse: 1.23456789 * 1e8 = 123456788.99999999 reste 1.23456789.
+    n, scale = lot
+    units = round(value * scale)
+    if units / scale > value: units -= 1
+    return (units - units % n) / scale
 
 def _to_exchange_precision(ex, symbol: str, amount: float) -> float:
     try: return float(ex.amount_to_precision(symbol, amount))
     except: return amount
 
-def _compute_base_qty_for_quote(ex, symbol: str, quote_amt: float) -> Tuple[float, float]:
+# Cache court ticker/balance: une rafale d'alertes TradingView ne refait pas
+# les mêmes appels REST. La balance est invalidée après chaque ordre.
+_cache_lock = threading.Lock()
+_ticker_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_balance_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+
+# DRY_RUN: prix du payload (ou DRY_RUN_PRICE) et balance simulée, sans REST.
+# _dry_px ne vit que le temps du webhook courant (vidé en fin de requête).
+_dry_px: Dict[str, float] = {}
+
+def _dry_balance(symbol: str) -> Dict[str, float]:
+    # Quote fixe (env) + base = position longue simulée du state sur ce symbole
+    base, quote = _symbol_parts(symbol)
+    with _state_lock:
+        long_here = _state.get("position_side") == "long" and _state.get("symbol") == symbol
+        qty = float(_state.get("last_qty") or 0.0) if long_here else 0.0
+    return {quote: DRY_RUN_QUOTE_FREE, base: qty}
+
+# Dernier ticker poussé par le WebSocket: symbole -> (monotonic, ticker).
+# Une affectation de dict est atomique sous le GIL: pas de lock en lecture.
+_ws_ticker: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+def _ws_ticker_loop(symbol: str):
+    import asyncio
+    import ccxt.pro as ccxtpro
+
+    async def run():
+        ws = ccxtpro.kraken({"enableRateLimit": True})
+        if KRAKEN_SANDBOX:
+            try: ws.set_sandbox_mode(True)
+            except Exception: pass
+        backoff = 1.0
+        try:
+            while True:
+                try:
+                    t = await ws.watch_ticker(symbol)
+                    _ws_ticker[symbol] = (time.monotonic(), t)
+                    backoff = 1.0
+                except Exception as e:
+                    # Reconnexion (au prochain watch_ticker) avec backoff exponentiel plafonné
+                    log.warning("[WS] ticker %s error: %s (retry in %.0fs)", symbol, e, backoff)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60.0)
+        finally:
+            await ws.close()
+
+    asyncio.run(run())
+
+def _cached_ticker(ex, symbol: str) -> Dict[str, Any]:
+    if DRY_RUN:
+        px = _dry_px.get(symbol) or DRY_RUN_PRICE
+        if px: return {"last": px}
+    hit = _ws_ticker.get(symbol)
+    if hit and time.monotonic() - hit[0] < WS_STALE_SEC: return hit[1]
+    with _cache_lock: hit = _ticker_cache.get(symbol)
+    if hit and time.monotonic() - hit[0] < TICKER_TTL_SEC: return hit[1]
     t = ex.fetch_ticker(symbol)
-    price = float(t.get("last") or t.get("close") or t.get("ask") or t.get("bid") or 0.0)
+    with _cache_lock: _ticker_cache[symbol] = (time.monotonic(), t)
+    return t
+
+def _cached_free_balance(ex, force: bool = False, symbol: str = SYMBOL_DEFAULT) -> Dict[str, Any]:
+    global _balance_cache
+    if DRY_RUN: return _dry_balance(symbol)
+    with _cache_lock: hit = _balance_cache
+    if hit and not force and time.monotonic() - hit[0] < BALANCE_TTL_SEC: return hit[1]
+    b = ex.fetch_free_balance()
+    with _cache_lock: _balance_cache = (time.monotonic(), b)
+    return b
+
+@lru_cache(maxsize=16)
+def _balance_aliases(code: str) -> Tuple[str, ...]:
+    # Code ccxt d'abord, puis les codes bruts Kraken (XXBT, ZEUR...) si ccxt
+    # n'a pas pu les unifier (ex: snapshot de marchés sans currencies).
+    aliases = [code, "X" + code, "Z" + code]
+    if code == "BTC": aliases += ["XBT", "XXBT"]
+    return tuple(aliases)
+
+def _free_amount(balances: Dict[str, Any], code: str) -> float:
+    for k in _balance_aliases(code):
+        v = balances.get(k)
+        if v is not None: return float(v)
+    return 0.0
+
+def _invalidate_balance():
+    global _balance_cache
+    with _cache_lock: _balance_cache = None
+
+def _ticker_price(t: Dict[str, Any], side: str = "buy") -> float:
+    # last/close, sinon le côté du carnet qu'on va traverser (ask en achat,
+    # bid en vente): déjà dans le ticker, pas de fetch_order_book en secours.
+    return float(t.get("last") or t.get("close") or (t.get("ask") if side == "buy" else t.get("bid")) or 0.0)
+
+def _fetch_price(ex, symbol: str, side: str = "buy") -> float:
+    price = _ticker_price(_cached_ticker(ex, symbol), side)
     if price <= 0: raise RuntimeError("Prix invalide (ticker)")
-    min_amount, min_cost, step = _get_min_trade_info(ex, symbol, price)
+    return price
+
+def _base_qty_for_quote_at(ex, symbol: str, quote_amt: float, price: float) -> float:
+    min_amount, min_cost, _, lot = _get_min_trade_info(ex, symbol, price)
     qty = (quote_amt / price) * (1.0 - FEE_BUFFER_PCT)
     if min_cost and (qty * price) < min_cost: qty = min_cost / price
     if min_amount and qty < min_amount: qty = min_amount
-    if step: qty = _round_floor(qty, step)
+    if lot: qty = _round_floor(qty, lot)
     if qty <= 0:
         required_quote = max(min_cost, (min_amount or 0)*price) or 0.0
         required_quote *= (1.0 + FEE_BUFFER_PCT)
-        raise RuntimeError(f"Montant trop faible. Essaie >= ~{required_quote:.2f} {symbol.split('/')[1]}")
-    return qty, price
+        raise RuntimeError(f"Montant trop faible. Essaie >= ~{required_quote:.2f} {_symbol_parts(symbol)[1]}")
+    return qty
+
+def _compute_base_qty_for_quote(ex, symbol: str, quote_amt: float, side: str = "buy") -> Tuple[float, float]:
+    price = _fetch_price(ex, symbol, side)
+    return _base_qty_for_quote_at(ex, symbol, quote_amt, price), price
 
 def _tp_sl_from_confidence(conf: int) -> Tuple[float, float]:
     return (0.008, 0.005) if conf >= 3 else (0.003, 0.002)
@@ -216,18 +569,18 @@ def _monitor_trailing(symbol: str, qty: float, entry: float, conf: int, base_sl_
     log.info("[TRAIL] start %s qty=%.8f entry=%.2f conf=%s baseSL=%.4f", symbol, qty, entry, conf, base_sl_pct)
     while True:
         try:
-            t = ex.fetch_ticker(symbol)
-            last = float(t.get("last") or t.get("close") or 0.0)
+            last = _ticker_price(ex.fetch_ticker(symbol), "sell")
             if last <= 0: time.sleep(3); continue
             if last <= initial_stop:
                 log.warning("[TRAIL] initial SL hit (%.2f <= %.2f) -> SELL", last, initial_stop)
                 try:
-                    _, _, step = _get_min_trade_info(ex, symbol, last)
-                    q = _round_floor(qty, step) if step else qty
+                    _, _, _, lot = _get_min_trade_info(ex, symbol, last)
+                    q = _round_floor(qty, lot) if lot else qty
                     q = _to_exchange_precision(ex, symbol, q)
                     if not DRY_RUN: ex.create_market_sell_order(symbol, q)
                 except Exception as e:
                     log.warning("[TRAIL] SELL initial failed: %s", e)
+                _invalidate_balance()
                 _with_state(lambda s: s.update({"has_position": False, "position_side": "none"}))
                 break
             if not activated and last >= entry * (1.0 + activate_pct):
@@ -239,12 +592,13 @@ def _monitor_trailing(symbol: str, qty: float, entry: float, conf: int, base_sl_
                 if last <= trail_stop:
                     log.info("[TRAIL] stop hit %.2f <= %.2f -> SELL", last, trail_stop)
                     try:
-                        _, _, step = _get_min_trade_info(ex, symbol, last)
-                        q = _round_floor(qty, step) if step else qty
+                        _, _, _, lot = _get_min_trade_info(ex, symbol, last)
+                        q = _round_floor(qty, lot) if lot else qty
                         q = _to_exchange_precision(ex, symbol, q)
                         if not DRY_RUN: ex.create_market_sell_order(symbol, q)
                     except Exception as e:
                         log.warning("[TRAIL] SELL failed: %s", e)
+                    _invalidate_balance()
                     _with_state(lambda s: s.update({"has_position": False, "position_side": "none"}))
                     break
             time.sleep(3)
@@ -253,10 +607,38 @@ def _monitor_trailing(symbol: str, qty: float, entry: float, conf: int, base_sl_
             time.sleep(3)
     log.info("[TRAIL] finished")
 
+def _payload_num(v: Any, default: float) -> float:
+    # Champ numérique du payload (str/int/float); vide, invalide ou non fini (nan/inf) -> défaut
+    if not v: return default
+    try: x = float(v)
+    except (TypeError, ValueError): return default
+    return x if math.isfinite(x) else default
+
+def _secret_ok(tok: Any) -> bool:
+    # Comparaison à temps constant (pas de fuite sur la longueur du préfixe commun)
+    return tok is not None and hmac.compare_digest(str(tok).encode(), _WEBHOOK_SECRET_B)
+
 # ===== Routes =====
+# Corps JSON constants, encodés une fois à l'import
+_INDEX_BODY        = _json_dumps({"service": "tv-kraken-bot", "status": "ok"})
+_RESP_UNAUTHORIZED = _json_dumps({"error": "unauthorized"})
+_RESP_BAD_SIGNAL   = _json_dumps({"error": "signal invalide (BUY/SELL/CLOSE/PING)"})
+_RESP_SHORT_OFF    = _json_dumps({"ok": False, "skipped": "no_base_and_short_disabled"})
+_RESP_BUSY         = _json_dumps({"ok": False, "error": "busy"})
+_RESP_NO_POSITION  = _json_dumps({"ok": False, "skipped": "no_position_to_close"})
+_RESP_COOLDOWN_FMT = b'{"ok":false,"reason":"buy_cooldown","cooldown_remaining_sec":%d}'
+
+# Alias acceptés -> signal canonique; une seule lecture de dict par webhook
+_SIGNAL_MAP = {"BUY": "BUY", "LONG": "BUY",
+               "SELL": "SELL", "SHORT": "SELL", "CLOSE": "CLOSE",
+               "PING": "PING"}
+
+def _raw_json(body: bytes, status: int = 200):
+    return app.response_class(body, status=status, mimetype="application/json")
+
 @app.get("/")
 def index():
-    return jsonify({"service": "tv-kraken-bot", "status": "ok"}), 200
+    return _raw_json(_INDEX_BODY)
 
 @app.get("/health")
 def health():
@@ -275,180 +657,355 @@ def debug_balances():
     try:
         if WEBHOOK_SECRET:
             tok = (request.args.get("secret") or request.headers.get("X-Webhook-Token"))
-            if tok != WEBHOOK_SECRET:
-                return jsonify({"error": "unauthorized"}), 401
+            if not _secret_ok(tok):
+                return _raw_json(_RESP_UNAUTHORIZED, 401)
         ex = _make_exchange()
         b = ex.fetch_balance()
         return jsonify({"free": b.get("free", {}), "used": b.get("used", {}), "total": b.get("total", {})}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Verrou fichier (flock) entre workers gunicorn: _position_lock ne couvre
+# qu'un process. Non bloquant: un doublon concurrent reçoit 409 au lieu d'attendre.
+# Le cooldown BUY est relu du STATE_FILE sous ce verrou (_sync_buy_cooldown);
+# le cache d'idempotence reste, lui, propre à chaque worker.
+_order_lock_fd: Optional[int] = None
+
+def _order_flock() -> bool:
+    global _order_lock_fd
+    if fcntl is None: return True
+    if _order_lock_fd is None:
+        _order_lock_fd = os.open(ORDER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(_order_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+def _order_funlock():
+    if fcntl is not None and _order_lock_fd is not None:
+        fcntl.flock(_order_lock_fd, fcntl.LOCK_UN)
+
+# Dédoublonnage des livraisons TradingView (retries): la réponse d'un ordre
+# exécuté est rejouée telle quelle au lieu de repasser l'ordre. Accès
+# uniquement sous _position_lock: pas de lock dédié.
+_IDEM_MAX = 512
+_idem_seen: "OrderedDict[Tuple[str, ...], Tuple[float, bytes, int]]" = OrderedDict()
+
+def _idem_key(payload: Dict[str, Any], signal: str, symbol: str) -> Optional[Tuple[str, ...]]:
+    if not IDEMPOTENCY_TTL_SEC: return None
+    alert_id = payload.get("id") or payload.get("alert_id")
+    if alert_id: return ("id", str(alert_id))
+    return (signal, symbol)
+
+def _idem_get(key: Optional[Tuple[str, ...]]) -> Optional[Tuple[bytes, int]]:
+    hit = _idem_seen.get(key) if key else None
+    # Sans id d'alerte: fenêtre glissante depuis le dernier ordre exécuté, et
+    # seulement s'il est le plus récent (BUY -> SELL -> BUY n'est pas avalé).
+    if hit and key[0] != "id":
+        if key != next(reversed(_idem_seen)): return None
+        ttl = IDEMPOTENCY_BUCKET_SEC
+    else:
+        ttl = IDEMPOTENCY_TTL_SEC
+    if hit and time.monotonic() - hit[0] < ttl: return hit[1], hit[2]
+    return None
+
+def _idem_store(key: Optional[Tuple[str, ...]], rv):
+    resp = app.make_response(rv)
+    if key:
+        _idem_seen[key] = (time.monotonic(), resp.get_data(), resp.status_code)
+        _idem_seen.move_to_end(key)
+        while len(_idem_seen) > _IDEM_MAX: _idem_seen.popitem(last=False)
+    return resp
+
+def _close_short(ex, symbol: str, qty: float, conf: int, reason: str, idem_key: Optional[Tuple[str, ...]]):
+    qty_to_buy = _to_exchange_precision(ex, symbol, qty)
+    if not DRY_RUN: order = ex.create_market_buy_order(symbol, qty_to_buy)
+    else: order = {"dry_run": True, "side":"buy", "qty": qty_to_buy}
+    _invalidate_balance()
+    _with_state(lambda s: s.update({
+        "has_position": False, "position_side":"none", "last_qty":0.0
+    }))
+    return _idem_store(idem_key, jsonify({"ok": True, "side":"buy-close-short", "symbol": symbol,
+                                          "amount": qty_to_buy, "order": order, "confidence": conf,
+                                          "reason": reason}))
+
+def _close_long(ex, symbol: str, reason: str, idem_key: Optional[Tuple[str, ...]]):
+    # None si aucun base libre (pas de long à fermer)
+    base = _symbol_parts(symbol)[0]
+    # Quantité vendue = solde réel: pas de snapshot en cache ici
+    balances = _cached_free_balance(ex, force=True, symbol=symbol)
+    base_free = _free_amount(balances, base)
+    if base_free <= 0: return None
+    price = _ticker_price(_cached_ticker(ex, symbol), "sell") or 1.0
+    min_amount, _, _, lot = _get_min_trade_info(ex, symbol, price)
+    qty_to_sell = max(0.0, base_free - BASE_RESERVE)
+    if lot: qty_to_sell = _round_floor(qty_to_sell, lot)
+    qty_to_sell = _to_exchange_precision(ex, symbol, qty_to_sell)
+    if qty_to_sell < max(min_amount, 0.0):
+        return jsonify({"ok": False, "skipped":"insufficient-base",
+                        "base_free": base_free, "min_amount": min_amount}), 200
+    if DRY_RUN: order = {"dry_run":True, "side":"sell", "symbol":symbol, "qty":qty_to_sell}
+    else: order = ex.create_market_sell_order(symbol, qty_to_sell)
+    _invalidate_balance()
+    _with_state(lambda s: s.update({"has_position": False, "position_side":"none", "last_qty":0.0}))
+    return _idem_store(idem_key, jsonify({"ok": True, "side":"sell-close-long", "symbol": symbol,
+                                          "amount": qty_to_sell, "order": order, "reason": reason}))
+
+# ============= BUY (open long OR close short) =============
+def _handle_buy(ex, symbol: str, conf: int, requested_quote: float, reason: str, idem_key: Optional[Tuple[str, ...]]):
+    quote = _symbol_parts(symbol)[1]
+    _, sl_pct = _tp_sl_from_confidence(conf)
+    with _state_lock: st = dict(_state)
+    # Si short ouvert -> BUY ferme le short (quantité connue)
+    if st.get("position_side") == "short" and st.get("last_qty", 0) > 0:
+        return _close_short(ex, symbol, st["last_qty"], conf, reason, idem_key)
+
+    # Sinon on ouvre un long (comme avant)
+    _sync_buy_cooldown()
+    wait_ns = _buy_cooldown_remaining_ns()
+    if wait_ns:
+        return _raw_json(_RESP_COOLDOWN_FMT % (wait_ns // 1_000_000_000))
+
+    if requested_quote < MIN_QUOTE_PER_TRADE:
+        return jsonify({"error":"sizing_error",
+                        "detail": f"Montant trop faible: min {MIN_QUOTE_PER_TRADE} {quote}"}), 400
+
+    # Balance (privé) et ticker (public) en parallèle: latence = max, pas somme.
+    fut_bal = _io_pool.submit(_cached_free_balance, ex, symbol=symbol)
+    fut_px  = _io_pool.submit(_fetch_price, ex, symbol)
+    balances = fut_bal.result()
+    avail_quote = _free_amount(balances, quote)
+    usable_quote = max(0.0, avail_quote - QUOTE_RESERVE)
+    quote_to_use = min(requested_quote, usable_quote)
+    if quote_to_use <= 0:
+        return jsonify({"error":"insufficient_quote","available":avail_quote,
+                        "quote_reserve": QUOTE_RESERVE}), 400
+
+    chunks = max(1, min(BUY_SPLIT_CHUNKS, 10))
+    per_chunk_quote = quote_to_use / chunks
+    # Un seul ticker par BUY: tous les chunks sont dimensionnés sur ce prix.
+    price = fut_px.result()
+    # Même prix, même quote par chunk: taille calculée une fois pour le groupe.
+    base_qty = _base_qty_for_quote_at(ex, symbol, per_chunk_quote, price)
+    _, _, step, _ = _get_min_trade_info(ex, symbol, price)
+    if step and chunks > 1:
+        # Découpage en lots entiers sur le budget total: le reste du floor
+        # par chunk va aux premiers chunks au lieu d'être perdu.
+        lots = max(round(base_qty / step) * chunks,
+                   int(quote_to_use * (1.0 - FEE_BUFFER_PCT) / price / step + 1e-9))
+        per, rem = divmod(lots, chunks)
+        hi = _to_exchange_precision(ex, symbol, (per + 1) * step)
+        lo = _to_exchange_precision(ex, symbol, per * step)
+        amounts = [hi] * rem + [lo] * (chunks - rem)
+    else:
+        amounts = [_to_exchange_precision(ex, symbol, base_qty)] * chunks
+
+    total_qty, vw_cost, orders = 0.0, 0.0, []
+    if DRY_RUN:
+        orders = [{"dry_run":True, "side":"buy", "symbol":symbol, "qty":a, "price":price} for a in amounts]
+    elif chunks > 1 and BUY_SPLIT_DELAY_MS == 0 and ex.has.get("createOrders"):
+        # Sans délai entre chunks: un seul AddOrderBatch signé au lieu de N allers-retours.
+        orders = ex.create_orders([{"symbol": symbol, "type": "market", "side": "buy", "amount": a}
+                                   for a in amounts])
+    else:
+        # Pas de throttle ccxt sur AddOrder (cost 0): le délai est entièrement à notre charge.
+        delay_s = BUY_SPLIT_DELAY_MS * 1e-3
+        last = len(amounts) - 1
+        for i, a in enumerate(amounts):
+            orders.append(ex.create_market_buy_order(symbol, a))
+            if delay_s and i < last:
+                time.sleep(delay_s)
+    for a, order in zip(amounts, orders):
+        # AddOrderBatch écarte les ordres invalides et passe les autres:
+        # seul un ordre avec txid et sans erreur compte dans la position.
+        err = (order.get("info") or {}).get("error")
+        if not order.get("dry_run") and (err or not order.get("id")):
+            log.warning("BUY chunk rejeté (%s %s): %s", a, symbol, err or "sans txid")
+            continue
+        fill_price = float(order.get("average") or order.get("price") or price)
+        total_qty += a
+        vw_cost += a * fill_price
+    _invalidate_balance()
+    if total_qty <= 0:
+        return jsonify({"error": "orders_rejected", "orders": orders}), 502
+    vwap = (vw_cost / total_qty) if total_qty > 0 else price
+
+    _mark_buy_now()
+    _with_state(lambda s: s.update({
+        "has_position": True, "position_side":"long",
+        "last_buy_ts": _now(), "last_entry_price": vwap,
+        "last_qty": total_qty, "symbol": symbol
+    }), flush=True)
+
+    if TRAILING_ENABLED and total_qty > 0:
+        threading.Thread(target=_monitor_trailing,
+                         args=(symbol, total_qty, vwap, conf, min(sl_pct, RISK_PCT)),
+                         daemon=True).start()
+    return _idem_store(idem_key, jsonify({"ok": True, "side":"buy-open-long", "symbol": symbol,
+                                          "amount": total_qty, "avg_price": vwap,
+                                          "orders": orders, "confidence": conf, "reason": reason}))
+
+# ============= SELL (close long OR open short) =============
+def _handle_sell(ex, symbol: str, conf: int, requested_quote: float, reason: str, idem_key: Optional[Tuple[str, ...]]):
+    quote = _symbol_parts(symbol)[1]
+    # 1) S'il y a du BTC libre -> on ferme le long
+    resp = _close_long(ex, symbol, reason, idem_key)
+    if resp is not None: return resp
+
+    # 2) Sinon pas de BTC : ouvrir un short si autorisé
+    if not ENABLE_SHORTING:
+        return _raw_json(_RESP_SHORT_OFF)
+
+    if requested_quote < MIN_QUOTE_PER_TRADE:
+        return jsonify({"error":"sizing_error",
+                        "detail": f"Montant trop faible: min {MIN_QUOTE_PER_TRADE} {quote}"}), 400
+
+    # quantité à vendre (base) calibrée sur le "quote" et le levier
+    base_qty, price = _compute_base_qty_for_quote(ex, symbol, requested_quote, "sell")
+    # avec levier N, Kraken gère la marge; nous vendons "base_qty * leverage" ?
+    # Par sécurité, on vend "base_qty" et on passe 'leverage' à l'API.
+    _, _, _, lot = _get_min_trade_info(ex, symbol, price)
+    if lot: base_qty = _round_floor(base_qty, lot)
+    base_qty = _to_exchange_precision(ex, symbol, base_qty)
+
+    params = {"leverage": str(MARGIN_LEVERAGE)} if MARGIN_LEVERAGE else {}
+    if DRY_RUN:
+        order = {"dry_run": True, "side":"sell", "symbol":symbol, "qty":base_qty, "leverage": MARGIN_LEVERAGE}
+    else:
+        # create_order: type, side, amount, price=None, params={}
+        order = ex.create_order(symbol, "market", "sell", base_qty, None, params)
+        _invalidate_balance()
+
+    _with_state(lambda s: s.update({
+        "has_position": True, "position_side":"short",
+        "last_entry_price": price, "last_qty": base_qty, "symbol": symbol
+    }))
+    return _idem_store(idem_key, jsonify({"ok": True, "side":"sell-open-short", "symbol": symbol,
+                                          "amount": base_qty, "order": order, "leverage": MARGIN_LEVERAGE,
+                                          "reason": reason}))
+
+# ============= CLOSE (ferme long ou short, n'ouvre jamais) =============
+def _handle_close(ex, symbol: str, conf: int, requested_quote: float, reason: str, idem_key: Optional[Tuple[str, ...]]):
+    with _state_lock: st = dict(_state)
+    if st.get("position_side") == "short" and st.get("last_qty", 0) > 0:
+        return _close_short(ex, symbol, st["last_qty"], conf, reason, idem_key)
+    resp = _close_long(ex, symbol, reason, idem_key)
+    if resp is not None: return resp
+    return _raw_json(_RESP_NO_POSITION)
+
+# Dispatch BUY/SELL/CLOSE (PING est traité avant, sans lock ni exchange)
+_SIGNAL_HANDLERS = {"BUY": _handle_buy, "SELL": _handle_sell, "CLOSE": _handle_close}
+
 @app.post("/webhook")
 def webhook():
+    # Secret en header/query: vérifié avant tout parsing JSON et avant le lock,
+    # le trafic non autorisé ne coûte ni décodage ni attente. Valeur vide ("?token=")
+    # -> None: le secret du body reste accepté.
+    hdr_tok = (request.headers.get("X-Webhook-Secret") or request.headers.get("X-Webhook-Token")
+               or request.args.get("secret") or request.args.get("token") or None)
+    if WEBHOOK_SECRET and hdr_tok is not None and not _secret_ok(hdr_tok):
+        log.error("Bad secret")
+        return _raw_json(_RESP_UNAUTHORIZED, 401)
     with _position_lock:
+        locked = False
         try:
-            payload = request.get_json(silent=True) or {}
-            if WEBHOOK_SECRET:
-                tok = (payload.get("secret") or request.args.get("secret")
-                       or payload.get("token") or request.args.get("token")
-                       or request.headers.get("X-Webhook-Token"))
-                if tok != WEBHOOK_SECRET:
+            try: payload = _json_loads(request.get_data(cache=False)) or {}
+            except ValueError: payload = {}
+            # Compat: secret dans le body JSON (alertes TradingView)
+            if WEBHOOK_SECRET and hdr_tok is None:
+                if not _secret_ok(payload.get("secret") or payload.get("token")):
                     log.error("Bad secret")
-                    return jsonify({"error": "unauthorized"}), 401
+                    return _raw_json(_RESP_UNAUTHORIZED, 401)
 
-            safe = dict(payload); safe.pop("secret", None); safe.pop("token", None)
-            log.info("Webhook payload: %s", json.dumps(safe, ensure_ascii=False))
+            if log.isEnabledFor(logging.DEBUG):
+                safe = dict(payload); safe.pop("secret", None); safe.pop("token", None)
+                log.debug("Webhook payload: %s", _json_dumps(safe).decode())
 
-            signal = (payload.get("signal") or "").upper()
+            signal = _SIGNAL_MAP.get(str(payload.get("signal") or "").strip().upper())
+            if signal is None:
+                return _raw_json(_RESP_BAD_SIGNAL, 400)
             if signal == "PING":
                 return jsonify({"ok": True, "pong": True, "ts": int(time.time())}), 200
-            if signal not in {"BUY","SELL"}:
-                return jsonify({"error":"signal invalide (BUY/SELL/PING)"}), 400
+            locked = _order_flock()
+            if not locked:
+                log.warning("Webhook busy (ordre en cours dans un autre worker)")
+                return _raw_json(_RESP_BUSY, 409)
 
             symbol = _maybe_symbol_from_payload(payload.get("symbol"))
-            conf = int(payload.get("confidence") or payload.get("indicators_count") or 2)
+            log.info("webhook sig=%s sym=%s", signal, symbol)
+            idem_key = _idem_key(payload, signal, symbol)
+            hit = _idem_get(idem_key)
+            if hit:
+                log.info("Webhook dupliqué %s: réponse précédente rejouée", idem_key)
+                return _raw_json(*hit)
+            conf = int(_payload_num(payload.get("confidence") or payload.get("indicators_count"), 2))
+            requested_quote = _payload_num(payload.get("quote"), FIXED_QUOTE_PER_TRADE)
             reason = str(payload.get("reason",""))[:160]
-            tp_pct, sl_pct = _tp_sl_from_confidence(conf)
+            if DRY_RUN:
+                # Prix de l'alerte TradingView ({{close}}): pas de fetch_ticker
+                hint = _payload_num(payload.get("price") or payload.get("close"), 0.0)
+                if hint > 0: _dry_px[symbol] = hint
 
             ex = _make_exchange()
             _load_markets(ex)
 
-            # ============= BUY (open long OR close short) =============
-            if signal == "BUY":
-                st = dict(_state)
-                # Si short ouvert -> BUY ferme le short (quantité connue)
-                if st.get("position_side") == "short" and st.get("last_qty", 0) > 0:
-                    qty_to_buy = st["last_qty"]
-                    qty_to_buy = _to_exchange_precision(ex, symbol, qty_to_buy)
-                    if not DRY_RUN: order = ex.create_market_buy_order(symbol, qty_to_buy)
-                    else: order = {"dry_run": True, "side":"buy", "qty": qty_to_buy}
-                    _with_state(lambda s: s.update({
-                        "has_position": False, "position_side":"none", "last_qty":0.0
-                    }))
-                    return jsonify({"ok": True, "side":"buy-close-short", "symbol": symbol,
-                                    "amount": qty_to_buy, "order": order, "confidence": conf,
-                                    "reason": reason}), 200
-
-                # Sinon on ouvre un long (comme avant)
-                now = _now()
-                if _state.get("last_buy_ts", 0) and (now - _state["last_buy_ts"] < BUY_COOL_SEC):
-                    wait = BUY_COOL_SEC - (now - _state["last_buy_ts"])
-                    return jsonify({"ok": False, "reason":"buy_cooldown",
-                                    "cooldown_remaining_sec": int(wait)}), 200
-
-                requested_quote = float(payload.get("quote") or FIXED_QUOTE_PER_TRADE)
-                if requested_quote < MIN_QUOTE_PER_TRADE:
-                    return jsonify({"error":"sizing_error",
-                                    "detail": f"Montant trop faible: min {MIN_QUOTE_PER_TRADE} {QUOTE_SYMBOL}"}), 400
-
-                balances = ex.fetch_free_balance()
-                avail_quote = float(balances.get(QUOTE_SYMBOL, 0.0))
-                usable_quote = max(0.0, avail_quote - QUOTE_RESERVE)
-                quote_to_use = min(requested_quote, usable_quote)
-                if quote_to_use <= 0:
-                    return jsonify({"error":"insufficient_quote","available":avail_quote,
-                                    "quote_reserve": QUOTE_RESERVE}), 400
-
-                chunks = max(1, min(BUY_SPLIT_CHUNKS, 10))
-                per_chunk_quote = quote_to_use / chunks
-                total_qty, vw_cost = 0.0, 0.0
-                last_price, orders = 0.0, []
-                for i in range(chunks):
-                    base_qty, price = _compute_base_qty_for_quote(ex, symbol, per_chunk_quote)
-                    last_price = price
-                    _, _, step = _get_min_trade_info(ex, symbol, price)
-                    if step: base_qty = _round_floor(base_qty, step)
-                    base_qty = _to_exchange_precision(ex, symbol, base_qty)
-                    if DRY_RUN:
-                        fill_price = price
-                        order = {"dry_run":True, "side":"buy", "symbol":symbol, "qty":base_qty, "price":fill_price}
-                    else:
-                        order = ex.create_market_buy_order(symbol, base_qty)
-                        fill_price = float(order.get("average") or order.get("price") or price)
-                    total_qty += base_qty
-                    vw_cost += base_qty * fill_price
-                    orders.append(order)
-                    if chunks > 1 and BUY_SPLIT_DELAY_MS > 0:
-                        time.sleep(BUY_SPLIT_DELAY_MS/1000.0)
-                vwap = (vw_cost / total_qty) if total_qty > 0 else last_price
-
-                _with_state(lambda s: s.update({
-                    "has_position": True, "position_side":"long",
-                    "last_buy_ts": _now(), "last_entry_price": vwap,
-                    "last_qty": total_qty, "symbol": symbol
-                }))
-
-                if TRAILING_ENABLED and total_qty > 0:
-                    threading.Thread(target=_monitor_trailing,
-                                     args=(symbol, total_qty, vwap, conf, min(sl_pct, RISK_PCT)),
-                                     daemon=True).start()
-                return jsonify({"ok": True, "side":"buy-open-long", "symbol": symbol,
-                                "amount": total_qty, "avg_price": vwap,
-                                "orders": orders, "confidence": conf, "reason": reason}), 200
-
-            # ============= SELL (close long OR open short) =============
-            if signal == "SELL":
-                balances = ex.fetch_free_balance()
-                base = symbol.split("/")[0]
-                base_free = float(balances.get(base, 0.0))
-
-                # 1) S'il y a du BTC libre -> on ferme le long
-                if base_free > 0:
-                    ticker = ex.fetch_ticker(symbol)
-                    price  = float(ticker.get("last") or ticker.get("close") or 0.0) or 1.0
-                    min_amount, _, step = _get_min_trade_info(ex, symbol, price)
-                    qty_to_sell = max(0.0, base_free - BASE_RESERVE)
-                    if step: qty_to_sell = _round_floor(qty_to_sell, step)
-                    qty_to_sell = _to_exchange_precision(ex, symbol, qty_to_sell)
-                    if qty_to_sell < max(min_amount, 0.0):
-                        return jsonify({"ok": False, "skipped":"insufficient-base",
-                                        "base_free": base_free, "min_amount": min_amount}), 200
-                    if DRY_RUN: order = {"dry_run":True, "side":"sell", "symbol":symbol, "qty":qty_to_sell}
-                    else: order = ex.create_market_sell_order(symbol, qty_to_sell)
-                    _with_state(lambda s: s.update({"has_position": False, "position_side":"none", "last_qty":0.0}))
-                    return jsonify({"ok": True, "side":"sell-close-long", "symbol": symbol,
-                                    "amount": qty_to_sell, "order": order, "reason": reason}), 200
-
-                # 2) Sinon pas de BTC : ouvrir un short si autorisé
-                if not ENABLE_SHORTING:
-                    return jsonify({"ok": False, "skipped":"no_base_and_short_disabled"}), 200
-
-                requested_quote = float(payload.get("quote") or FIXED_QUOTE_PER_TRADE)
-                if requested_quote < MIN_QUOTE_PER_TRADE:
-                    return jsonify({"error":"sizing_error",
-                                    "detail": f"Montant trop faible: min {MIN_QUOTE_PER_TRADE} {QUOTE_SYMBOL}"}), 400
-
-                # quantité à vendre (base) calibrée sur le "quote" et le levier
-                base_qty, price = _compute_base_qty_for_quote(ex, symbol, requested_quote)
-                # avec levier N, Kraken gère la marge; nous vendons "base_qty * leverage" ?
-                # Par sécurité, on vend "base_qty" et on passe 'leverage' à l'API.
-                _, _, step = _get_min_trade_info(ex, symbol, price)
-                if step: base_qty = _round_floor(base_qty, step)
-                base_qty = _to_exchange_precision(ex, symbol, base_qty)
-
-                params = {"leverage": str(MARGIN_LEVERAGE)} if MARGIN_LEVERAGE else {}
-                if DRY_RUN:
-                    order = {"dry_run": True, "side":"sell", "symbol":symbol, "qty":base_qty, "leverage": MARGIN_LEVERAGE}
-                else:
-                    # create_order: type, side, amount, price=None, params={}
-                    order = ex.create_order(symbol, "market", "sell", base_qty, None, params)
-
-                _with_state(lambda s: s.update({
-                    "has_position": True, "position_side":"short",
-                    "last_entry_price": price, "last_qty": base_qty, "symbol": symbol
-                }))
-                return jsonify({"ok": True, "side":"sell-open-short", "symbol": symbol,
-                                "amount": base_qty, "order": order, "leverage": MARGIN_LEVERAGE,
-                                "reason": reason}), 200
-
-            return jsonify({"error": f"unknown-signal:{signal}"}), 400
+            return _SIGNAL_HANDLERS[signal](ex, symbol, conf, requested_quote, reason, idem_key)
 
         except Exception as e:
             log.exception("webhook error")
             return jsonify({"error": str(e)}), 500
+        finally:
+            if locked: _order_funlock()
+            _dry_px.clear()
+
+def _log_crypto_backend():
+    # ccxt signe chaque appel privé Kraken (SHA256 + HMAC-SHA512) via OpenSSL:
+    # on trace la version et la présence des instructions SHA (sha_ni) du CPU.
+    sha_ni = None
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    sha_ni = " sha_ni " in f" {line.split(':', 1)[-1].strip()} "
+                    break
+    except OSError:
+        pass
+    log.info("CRYPTO backend: %s | sha_ni=%s", ssl.OPENSSL_VERSION, sha_ni)
+
+def _prewarm_markets():
+    # gunicorn importe le module sans passer par __main__: on charge les marchés
+    # ici pour que le premier BUY ne paie pas le load_markets (~500 ms+),
+    # ni l'extraction limites/pas du symbole par défaut.
+    try:
+        _load_markets(_make_exchange())
+        _market_trade_info(SYMBOL_DEFAULT)
+    except Exception as e:
+        log.warning("MARKETS prewarm skipped: %s", e)
+
+def _markets_refresher():
+    while True:
+        time.sleep(MARKETS_REFRESH_SEC)
+        try: _refresh_markets(_make_exchange())
+        except Exception as e: log.warning("MARKETS refresher: %s", e)
+
+def _start_markets_refresher():
+    if not MARKETS_REFRESH_SEC: return
+    threading.Thread(target=_markets_refresher, name="markets-refresher", daemon=True).start()
+
+def _start_ws_ticker():
+    if not WS_TICKER: return
+    threading.Thread(target=_ws_ticker_loop, args=(SYMBOL_DEFAULT,), name="ws-ticker", daemon=True).start()
 
 # ===== Boot =====
 _load_state()
+threading.Thread(target=_state_flusher, name="state-flusher", daemon=True).start()
+atexit.register(_write_state_atomic)
+_log_crypto_backend()
+_prewarm_markets()
+_start_markets_refresher()
+_start_ws_ticker()
 if __name__ == "__main__":
+    # Dev local uniquement; en prod: gunicorn -c gunicorn.conf.py (gthread)
     port = int(os.getenv("PORT","10000"))
     app.run(host="0.0.0.0", port=port)
@@ -1,13 +1,16 @@
 # gunicorn.conf.py
+import os
 
 # Logs sur stdout/stderr (Render les capte)
 accesslog = "-"
 errorlog  = "-"
 loglevel  = "info"   # ou "debug" si tu veux plus de verbosité
 
-# Un seul worker + threads, stable pour le plan Free
+# Un seul worker + threads, stable pour le plan Free.
+# Plusieurs threads: /health et /debug restent servis pendant qu'un webhook
+# attend Kraken (les ordres restent sérialisés par _position_lock dans app.py).
 worker_class = "gthread"
-threads = 1
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
 
 # Timeouts raisonnables pour webhooks lents
 timeout = 120